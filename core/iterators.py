@@ -27,6 +27,7 @@ class SequenceIterator:
         self.curr_iter = 0
         self.total_lines = batches.size(0)
         self.total_iters = self.total_lines // self.bptt - 1
+        self.lengths = self.sample_lengths()
 
     @property
     def completed(self):
@@ -38,6 +39,7 @@ class SequenceIterator:
 
     def __iter__(self):
         self.curr_line = self.curr_iter = 0
+        self.lengths = self.sample_lengths()
         return self
 
     def __next__(self):
@@ -62,11 +64,18 @@ class SequenceIterator:
         """
         if self.random_length is None:
             return self.bptt
-        bptt = self.bptt
-        if np.random.random() >= 0.95:
-            bptt /= 2
-        seq_len = max(5, int(np.random.normal(bptt, 5)))
-        return seq_len
+        return int(self.lengths[self.curr_iter])
+
+    def sample_lengths(self):
+        """
+        Generates randomized sequence lengths for all iterations of the epoch
+        at once.
+        """
+        if self.random_length is None:
+            return None
+        n = max(0, self.total_iters)
+        bptt = np.where(np.random.random(n) >= 0.95, self.bptt/2, self.bptt)
+        return np.maximum(5, np.random.normal(bptt, 5).astype(np.int64))
 
     def get_batch(self, seq_len):
         """
@@ -75,8 +84,10 @@ class SequenceIterator:
         """
         i, source = self.curr_line, self.batches
         seq_len = min(seq_len, self.total_lines - 1 - i)
-        X = source[i:i + seq_len].contiguous()
-        y = source[(i + 1):(i + 1) + seq_len].contiguous()
+        # slices along the first dimension of contiguous tensor are
+        # contiguous already, so no copy is required
+        X = source[i:i + seq_len]
+        y = source[(i + 1):(i + 1) + seq_len]
         if self.flatten_target:
             y = y.view(-1)
         return X, y
\ No newline at end of file
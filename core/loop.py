@@ -1,7 +1,10 @@
 from collections import defaultdict
+from itertools import chain
+from multiprocessing import cpu_count
 
 import torch
 from torch.nn import functional as F
+from torch.utils.data import DataLoader, Dataset, IterableDataset
 
 from .callbacks import CallbackGroup
 
@@ -22,9 +25,28 @@ class Loop:
 
                 new_loss = old_loss*alpha + (1 - alpha)*new_loss
 
+        compile: If True, then the model is compiled with `torch.compile` by
+            the stepper.
+
+        amp: If True, then the stepper computes forward pass with mixed
+            precision using `amp_dtype` type.
+
+    The datasets passed into the loop should yield complete batches. Instances
+    of `torch.utils.data.Dataset` are wrapped with `DataLoader` that fetches
+    batches in `num_workers` processes and copies them into pinned memory when
+    training on GPU. Any other iterable, including a `DataLoader` created by
+    the caller, is traversed as is.
+
+    Map-style datasets should implement `__len__` in addition to
+    `__getitem__`, and are loaded with all CPUs by default. Iterable datasets
+    are loaded in the main process unless `num_workers` is given explicitly,
+    because each worker replays the whole dataset; they should split batches
+    between workers with `get_worker_info()` to be used with several workers.
+
     """
     def __init__(self, model, optimizer, schedule, alpha: float=0.98,
-                 move_to_device=True, device=None):
+                 move_to_device=True, device=None, compile: bool=False,
+                 amp: bool=False, amp_dtype=torch.bfloat16):
 
         if move_to_device:
             device = torch.device(device or 'cpu')
@@ -36,15 +58,22 @@ class Loop:
         self.schedule = schedule
         self.alpha = alpha
         self.move_to_device = move_to_device
+        self.compile = compile
+        self.amp = amp
+        self.amp_dtype = amp_dtype
         self.stop = False
         self.callbacks = None
         self.stepper = None
 
     def run(self, train_data, valid_data=None, loss_fn=F.nll_loss,
-            epochs: int=100, callbacks=None, metrics=None):
+            epochs: int=100, callbacks=None, metrics=None,
+            num_workers: int=None, prefetch_factor: int=2):
 
+        train_data = self.make_loader(train_data, num_workers, prefetch_factor)
         phases = [Phase(name='train', dataset=train_data)]
         if valid_data is not None:
+            valid_data = self.make_loader(
+                valid_data, num_workers, prefetch_factor)
             phases.append(Phase(name='valid', dataset=valid_data))
 
         cb = CallbackGroup(callbacks)
@@ -61,8 +90,7 @@ class Loop:
             for phase in phases:
                 cb.epoch_start(epoch)
                 is_training = phase.name == 'train'
-                for batch in phase.dataset:
-                    x, y = self._place_and_unwrap_if_needed(batch)
+                for x, y in self._iterate(phase.dataset):
                     phase.batch_num += 1
                     cb.batch_start(epoch, phase)
                     batch_metrics = self.stepper.step(x, y, is_training)
@@ -71,13 +99,42 @@ class Loop:
                 metrics.update({
                     f'{phase.name}_{k}': v
                     for k, v in phase.metrics.items()})
+            if self.uses_cuda:
+                # wait for queued kernels so epoch timings are accurate
+                torch.cuda.synchronize(self.device)
             cb.epoch_end(epoch, metrics)
         cb.training_end()
 
+    def make_loader(self, dataset, num_workers: int=None,
+                    prefetch_factor: int=2):
+        """
+        Wraps dataset with data loader to prefetch batches in parallel with
+        training steps.
+
+        The dataset's items are expected to be complete batches, so the loader
+        doesn't perform its own batching. If `num_workers` is None, then the
+        number of CPUs is used for map-style datasets, and no workers are used
+        for iterable ones. Each worker keeps `prefetch_factor` batches loaded
+        in advance.
+        """
+        if not isinstance(dataset, Dataset):
+            return dataset
+        if num_workers is None:
+            iterable = isinstance(dataset, IterableDataset)
+            num_workers = 0 if iterable else cpu_count()
+        extra = {}
+        if num_workers > 0:
+            extra = dict(
+                prefetch_factor=prefetch_factor, persistent_workers=True)
+        return DataLoader(
+            dataset, batch_size=None, num_workers=num_workers,
+            pin_memory=self.uses_cuda, **extra)
+
     def make_stepper(self, loss_fn, metrics=None, stepper=None):
         stepper_cls = stepper or Stepper
         inst = stepper_cls(
-            self.model, self.optimizer, self.schedule, loss_fn, metrics)
+            self.model, self.optimizer, self.schedule, loss_fn, metrics,
+            compile=self.compile, amp=self.amp, amp_dtype=self.amp_dtype)
         return inst
 
     def save_model(self, path):
@@ -87,22 +144,73 @@ class Loop:
         a = self.alpha
         updated = {}
         for name, new_value in batch_metrics.items():
-            old_value = phase.rolling_metrics[name]
-            avg_value = a*old_value + (1 - a)*new_value
+            if torch.is_tensor(new_value):
+                # update the tensor accumulator in-place to keep it on device
+                if name not in phase.rolling_metrics:
+                    phase.rolling_metrics[name] = torch.zeros_like(new_value)
+                avg_value = phase.rolling_metrics[name]
+                avg_value.mul_(a).add_(new_value, alpha=1 - a)
+            else:
+                old_value = phase.rolling_metrics[name]
+                avg_value = a*old_value + (1 - a)*new_value
+                phase.rolling_metrics[name] = avg_value
             debias_value = avg_value/(1 - a**phase.batch_num)
             updated[name] = debias_value
-            phase.rolling_metrics[name] = avg_value
         phase.metrics = updated
 
+    @property
+    def uses_cuda(self):
+        return self.move_to_device and self.device.type == 'cuda'
+
     @property
     def lr_schedule(self):
         return self.stepper.learning_rates
 
+    def _iterate(self, dataset):
+        """
+        Yields batches placed onto the loop's device.
+
+        When training on GPU with batches in pinned memory, the next batch is
+        copied on a separate CUDA stream while the current one is processed by
+        the model, so the transfer overlaps with the forward and backward
+        passes. Copies from pageable memory are synchronous anyway, so such
+        batches are placed on the default stream.
+        """
+        batches = iter(dataset)
+        first = next(batches, None)
+        if first is None:
+            return
+        batches = chain([first], batches)
+
+        if not (self.uses_cuda and _is_pinned(first)):
+            for batch in batches:
+                yield self._place_and_unwrap_if_needed(batch)
+            return
+
+        copy_stream = torch.cuda.Stream(self.device)
+
+        def prefetch():
+            batch = next(batches, None)
+            if batch is None:
+                return None
+            with torch.cuda.stream(copy_stream):
+                return self._place_and_unwrap_if_needed(batch)
+
+        next_batch = prefetch()
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(copy_stream)
+            x, y = next_batch
+            for tensor in _flatten(x, y):
+                tensor.record_stream(current_stream)
+            next_batch = prefetch()
+            yield x, y
+
     def _place_and_unwrap_if_needed(self, batch):
         x, *y = batch
         if self.move_to_device:
-            x = x.to(self.device)
-            y = [tensor.to(self.device) for tensor in y]
+            x = x.to(self.device, non_blocking=True)
+            y = [tensor.to(self.device, non_blocking=True) for tensor in y]
         else:
             x, *y = batch
         if len(y) == 1:
@@ -113,6 +221,20 @@ class Loop:
         return self.callbacks[item]
 
 
+def _flatten(*tensors):
+    for tensor in tensors:
+        if isinstance(tensor, (list, tuple)):
+            yield from _flatten(*tensor)
+        else:
+            yield tensor
+
+
+def _is_pinned(batch):
+    return all(
+        tensor.is_pinned() for tensor in _flatten(*batch)
+        if torch.is_tensor(tensor))
+
+
 class Phase:
     """
     Model training loop phase.
@@ -129,6 +251,31 @@ class Phase:
         self.rolling_metrics = defaultdict(lambda: 0)
         self.metrics = None
 
+    @property
+    def metrics(self):
+        """
+        Returns metrics averaged up to the latest batch.
+
+        The values could be kept on device as tensors to avoid synchronization
+        on each training step, and are converted into numbers only on access.
+        """
+        if self._metrics is None:
+            return None
+        return {
+            key: value.item() if torch.is_tensor(value) else value
+            for key, value in self._metrics.items()}
+
+    @metrics.setter
+    def metrics(self, values):
+        self._metrics = values
+
+    @property
+    def avg_loss(self):
+        if self._metrics is None or 'loss' not in self._metrics:
+            return None
+        loss = self._metrics['loss']
+        return loss.item() if torch.is_tensor(loss) else loss
+
     def __repr__(self):
         if self.metrics is None:
             return f'<Phase: {self.name}, metrics: none>'
@@ -145,11 +292,32 @@ class Stepper:
 
     The stepper instance is invoked during each training iteration and returns
     the loss on batch.
+
+    If `compile` is True and PyTorch supports it, the model's forward pass is
+    compiled with `torch.compile`. The original model is kept to switch between
+    training and evaluation modes and to save its state. Note that the
+    compilation happens on the first batches, so their step time includes the
+    compile time (and on CPU, a working C++ compiler is required).
+
+    If `amp` is True, the forward pass is computed with mixed precision using
+    `amp_dtype` type. For float16, the loss is scaled to prevent gradients
+    underflow, which requires `torch.amp.GradScaler` (PyTorch 2.3 or later).
     """
-    def __init__(self, model, optimizer, schedule, loss, metrics=None):
+    def __init__(self, model, optimizer, schedule, loss, metrics=None,
+                 compile: bool=False, amp: bool=False,
+                 amp_dtype=torch.bfloat16):
         if schedule.last_epoch == -1:
             schedule.step()
         self.model = model
+        self.compiled_model = model
+        if compile and hasattr(torch, 'compile'):
+            self.compiled_model = torch.compile(model)
+        self.device_type = next(model.parameters()).device.type
+        self.amp = amp
+        self.amp_dtype = amp_dtype
+        self.scaler = None
+        if amp and amp_dtype == torch.float16:
+            self.scaler = torch.amp.GradScaler(self.device_type)
         self.optimizer = optimizer
         self.schedule = schedule
         self.loss = loss
@@ -163,35 +331,56 @@ class Stepper:
         Args:
             x: Features tensor.
             y: Target tensor.
-            train: If False, then the gradient is not computed, and the model's
-                parameters are not updated.
+            train: If False, then the step is performed in inference mode, and
+                the model's parameters are not updated.
 
         Returns:
-            loss: The loss value on batch.
+            metrics: The loss tensor on batch and values of the metrics.
 
         """
         metrics = {}
         self.model.train(train)
+        grad_mode = torch.enable_grad() if train else torch.inference_mode()
 
-        with torch.set_grad_enabled(train):
-            out = self.model(x)
-            loss = self.loss(out, y)
-            metrics['loss'] = loss.item()
+        autocast = torch.autocast(
+            self.device_type, dtype=self.amp_dtype, enabled=self.amp)
+
+        with grad_mode:
+            with autocast:
+                out = self.compiled_model(x)
+                loss = self.loss(out, y)
+            metrics['loss'] = loss.detach()
 
             if self.metrics is not None:
                 for metric in self.metrics:
-                    metrics[metric.__name__] = metric(out.cpu(), y.cpu())
+                    metrics[metric.__name__] = metric(out.detach(), y)
 
             if train:
-                self.optimizer.zero_grad()
-                loss.backward()
-                self.optimizer.step()
-                self.schedule.step()
+                self.optimizer.zero_grad(set_to_none=True)
+                if self.scaler is None:
+                    loss.backward()
+                    self.optimizer.step()
+                    self.schedule.step()
+                else:
+                    self.scaled_step(loss)
                 lrs = self.schedule.get_lr()
                 self.learning_rates.append(lrs)
 
         return metrics
 
+    def scaled_step(self, loss):
+        """
+        Performs backward pass and optimizer step with the scaled loss.
+        """
+        self.scaler.scale(loss).backward()
+        scale = self.scaler.get_scale()
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+        # the scale drops when the optimizer step is skipped due to inf/NaN
+        # gradients, so the schedule should not advance too
+        if self.scaler.get_scale() >= scale:
+            self.schedule.step()
+
     def save_model(self, path: str):
         """
         Saves model state into file.
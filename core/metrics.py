@@ -2,6 +2,8 @@ import torch
 
 
 def accuracy(y_pred, y_true):
+    """Returns the accuracy as a 0-d tensor on the predictions' device."""
+
     match = y_pred.argmax(dim=1) == y_true
     acc = match.type(torch.float).mean()
-    return acc.item()
+    return acc.detach()
@@ -1,8 +1,13 @@
+import os
 import pickle
+import hashlib
+import inspect
 import argparse
 from textwrap import wrap
 from pathlib import Path
-from collections import Counter, defaultdict
+from collections import Counter
+from itertools import chain, islice
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Pool, cpu_count
 
 import numpy as np
@@ -14,7 +19,8 @@ import torch
 from torch import nn
 from torch import optim
 from torch.nn import functional as F
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset
+from torch.utils.data import get_worker_info
 
 from rules import default_rules
 from core.loop import Loop
@@ -58,7 +64,9 @@ def main():
     loop.run(train_data=train, valid_data=valid,
              loss_fn=F.cross_entropy,
              metrics=[accuracy],
-             callbacks=default_callbacks())
+             callbacks=default_callbacks(),
+             num_workers=cpu_count(),
+             prefetch_factor=4)
 
     best_model = loop['Checkpoint'].best_model
     print('Best model: %s' % best_model)
@@ -75,16 +83,18 @@ def create_or_restore(path: Path):
     into memory.
     """
     datasets_dir = path / 'datasets'
+    names = ('train_sup', 'test_sup', 'train_unsup', 'test_unsup')
+    files = {name: datasets_dir / f'{name}.npz' for name in names}
 
-    if datasets_dir.exists():
+    if all(filename.exists() for filename in files.values()):
         print('Loading data from %s' % datasets_dir)
-        datasets = {}
-        for filename in datasets_dir.glob('*.pickle'):
-            datasets[filename.stem] = ImdbDataset.load(filename)
+        datasets = {
+            name: ImdbDataset.load(filename)
+            for name, filename in files.items()}
 
     else:
         print('Creating folder %s' % datasets_dir)
-        datasets_dir.mkdir(parents=True)
+        datasets_dir.mkdir(parents=True, exist_ok=True)
 
         print('Preparing datasets...')
 
@@ -117,7 +127,7 @@ def create_or_restore(path: Path):
 
         for name, dataset in datasets.items():
             print(f'Saving dataset {name}')
-            dataset.save(datasets_dir / f'{name}.pickle')
+            dataset.save(files[name])
 
     for name, dataset in datasets.items():
         print(f'{name} vocab size: {dataset.vocab.size}')
@@ -145,7 +155,8 @@ class ImdbDataset(Dataset):
     +-------+------------+--------+-------+---------+
     """
     def __init__(self, root: Path, train=True, supervised=False,
-                 tokenizer=None, vocab=None, make_vocab=None):
+                 tokenizer=None, vocab=None, make_vocab=None,
+                 cache_tokens=True):
         """
         Args:
              root: Path to the folder with train and tests subfolders.
@@ -154,6 +165,9 @@ class ImdbDataset(Dataset):
              vocab: Dataset vocab used to convert tokens into digits.
              make_vocab: Callable creating vocab from tokens. Note that this
                 parameter should be provided in case if `vocab` doesn't present.
+             cache_tokens: If True, then the tokenizer output is saved into
+                `root/cache` folder and reused when the dataset is created
+                again with the same tokenizer, rules and spaCy version.
 
         """
         assert vocab or make_vocab, 'Nor vocabulary, not function provided'
@@ -163,6 +177,7 @@ class ImdbDataset(Dataset):
         self.supervised = supervised
 
         subfolder = root / ('train' if train else 'test')
+        use_cache = tokenizer is not None and cache_tokens
         if tokenizer is None:
             tokenizer = lambda x: x
 
@@ -171,9 +186,9 @@ class ImdbDataset(Dataset):
             for index, label in enumerate(CLASSES):
                 if label == 'unsup':
                     continue
-                for filename in (subfolder/label).glob('*.txt'):
-                    texts.append(filename.open('r').read())
-                    labels.append(index)
+                label_texts = read_texts(subfolder/label)
+                texts += label_texts
+                labels += [index] * len(label_texts)
             if train:
                 self.train_labels = labels
             else:
@@ -182,45 +197,89 @@ class ImdbDataset(Dataset):
         else:
             texts = []
             for label in CLASSES:
-                files_folder = subfolder/label
-                for filename in files_folder.glob('*.txt'):
-                    texts.append(filename.open('r').read())
-
-        tokens = tokenizer(texts)
+                texts += read_texts(subfolder/label)
+
+        if use_cache:
+            name = '_'.join([
+                'tokens',
+                'train' if train else 'test',
+                'sup' if supervised else 'unsup',
+                tokens_cache_key(tokenizer, texts)])
+            cache_file = root / 'cache' / f'{name}.pickle'
+            tokens = tokenize_with_cache(tokenizer, texts, cache_file)
+        else:
+            tokens = tokenizer(texts)
         if make_vocab:
             vocab = make_vocab(tokens)
-        num_tokens = vocab.numericalize(tokens)
 
+        # all texts are kept in a single array, and i-th text is located
+        # between offsets[i] and offsets[i + 1] positions
         self.vocab = vocab
-        if train:
-            self.train_data = num_tokens
-        else:
-            self.test_data = num_tokens
+        self._data, self._offsets = vocab.numericalize_packed(tokens)
 
     def __getitem__(self, index):
-        if self.train and self.supervised:
-            return self.train_data[index], self.train_labels[index]
-        elif self.train and not self.supervised:
-            return self.train_data[index]
-        elif not self.train and self.supervised:
-            return self.test_data[index], self.test_labels[index]
-        else:
-            return self.test_data[index]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('dataset index out of range')
+        start, end = self._offsets[index], self._offsets[index + 1]
+        tokens = self._data[start:end]
+        if self.supervised:
+            labels = self.train_labels if self.train else self.test_labels
+            return tokens, labels[index]
+        return tokens
 
     def __len__(self):
-        return len(self.train_data if self.train else self.test_data)
+        return len(self._offsets) - 1
+
+    @property
+    def tokens(self):
+        """All numericalized texts concatenated into single array."""
+        return self._data
 
     def save(self, path):
-        with path.open('wb') as file:
-            pickle.dump(self, file)
+        """Saves the packed array of tokens with offsets of each text."""
+        labels = getattr(self, 'train_labels' if self.train else 'test_labels', [])
+        np.savez(
+            path,
+            data=self._data,
+            offsets=self._offsets,
+            labels=np.array(labels, dtype=np.int64),
+            itos=np.array(self.vocab.itos, dtype=str),
+            flags=np.array([self.train, self.supervised]),
+            root=np.array(str(self.root)))
 
     @staticmethod
     def load(path):
-        with path.open('rb') as file:
-            dataset = pickle.load(file)
+        with np.load(path) as arrays:
+            labels = arrays['labels'].tolist()
+            train, supervised = arrays['flags'].tolist()
+            dataset = ImdbDataset.__new__(ImdbDataset)
+            dataset.root = Path(str(arrays['root']))
+            dataset.train = train
+            dataset.supervised = supervised
+            dataset.vocab = Vocab(arrays['itos'].tolist())
+            dataset._data = arrays['data']
+            dataset._offsets = arrays['offsets']
+        if supervised:
+            setattr(dataset, 'train_labels' if train else 'test_labels', labels)
         return dataset
 
 
+def read_texts(folder: Path, n_threads: int=32):
+    """Reads all text files from the folder using a pool of threads."""
+
+    with os.scandir(folder) as entries:
+        files = sorted(e.path for e in entries if e.name.endswith('.txt'))
+    with ThreadPoolExecutor(n_threads) as executor:
+        return list(executor.map(read_text, files))
+
+
+def read_text(path: str):
+    with open(path, 'rb') as file:
+        return file.read().decode('utf8', 'ignore')
+
+
 class SpacyTokenizer:
     """A thin wrapper on top of Spacy tokenization tools."""
 
@@ -236,10 +295,23 @@ class SpacyTokenizer:
     def tokenize(self, text: str):
         """Converts a single string into list of tokens."""
 
-        for rule in self.rules:
-            text = rule(text)
+        text = apply_rules(text, self.rules)
         return [t.text for t in self.tokenizer(text)]
 
+    def tokenize_all(self, texts, batch_size: int=1000):
+        """Converts a list of strings into lists of tokens processing texts
+        in batches.
+        """
+        texts = (apply_rules(text, self.rules) for text in texts)
+        docs = self.tokenizer.pipe(texts, batch_size=batch_size)
+        return [[t.text for t in doc] for doc in docs]
+
+
+def apply_rules(text: str, rules=default_rules):
+    for rule in rules:
+        text = rule(text)
+    return text
+
 
 def tokenize_in_parallel(texts):
     n_workers = cpu_count()
@@ -251,7 +323,52 @@ def tokenize_in_parallel(texts):
 
 def tokenize(texts):
     tokenizer = SpacyTokenizer()
-    return [tokenizer.tokenize(text) for text in texts]
+    return tokenizer.tokenize_all(texts)
+
+
+def count_in_parallel(tokens):
+    n_workers = cpu_count()
+    parts = split_into(tokens, len(tokens)//n_workers + 1)
+    with Pool(n_workers) as pool:
+        counters = pool.map(count_tokens, parts)
+    freq = Counter()
+    for counter in counters:
+        freq.update(counter)
+    return freq
+
+
+def count_tokens(sentences):
+    return Counter(token for sentence in sentences for token in sentence)
+
+
+def tokenize_with_cache(tokenizer, texts, cache_file: Path):
+    """Restores tokens from cache file if it exists, or tokenizes texts and
+    saves the result into the file otherwise.
+    """
+    if cache_file.exists():
+        with cache_file.open('rb') as file:
+            tokens = pickle.load(file)
+        if len(tokens) == len(texts):
+            return tokens
+    tokens = tokenizer(texts)
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    with cache_file.open('wb') as file:
+        pickle.dump(tokens, file)
+    return tokens
+
+
+def tokens_cache_key(tokenizer, texts, rules=default_rules):
+    """Returns a short hash identifying tokenizer's output on texts."""
+
+    parts = [spacy.__version__, getattr(tokenizer, '__name__', repr(tokenizer))]
+    parts += list(SPECIAL_TOKENS)
+    parts += [inspect.getsource(SpacyTokenizer)]
+    parts += [inspect.getsource(rule) for rule in rules]
+    digest = hashlib.md5('\n'.join(parts).encode('utf8'))
+    for text in texts:
+        digest.update(text.encode('utf8'))
+        digest.update(b'\0')
+    return digest.hexdigest()[:8]
 
 
 def split_into(arr, n):
@@ -262,9 +379,20 @@ class Vocab:
 
     def __init__(self, itos):
         self.itos = itos
-        self.stoi = defaultdict(int, {v: k for k, v in enumerate(itos)})
+        self.stoi = {v: k for k, v in enumerate(itos)}
         self.size = len(itos)
 
+        # sorted tokens and their indexes for vectorized lookup
+        tokens = np.array(itos, dtype=str)
+        order = np.argsort(tokens)
+        self._sorted = tokens[order]
+        self._sorted_idx = order.astype(np.int32)
+
+        # the tokens longer than any vocabulary entry are truncated to one
+        # extra character, so they never match but don't waste memory
+        max_len = self._sorted.dtype.itemsize // 4
+        self._token_dtype = f'<U{max_len + 1}'
+
     def __eq__(self, other):
         if not isinstance(other, Vocab):
             raise TypeError(
@@ -284,7 +412,7 @@ class Vocab:
 
     @staticmethod
     def make_vocab(tokens, min_freq: int=3, max_vocab: int=60000, pad=PAD, unknown=UNK) -> 'Vocab':
-        freq = Counter(token for sentence in tokens for token in sentence)
+        freq = count_in_parallel(tokens)
         most_common = freq.most_common(max_vocab)
         itos = [token for token, count in most_common if count > min_freq]
         itos.insert(0, pad)
@@ -294,9 +422,36 @@ class Vocab:
         return Vocab(itos)
 
     def numericalize(self, texts):
-        return [
-            np.array([self.stoi[token] for token in text], dtype=np.int)
-            for text in texts]
+        data, offsets = self.numericalize_packed(texts)
+        if len(offsets) == 1:
+            return []
+        return np.split(data, offsets[1:-1])
+
+    def numericalize_packed(self, texts, chunk_size: int=1000000):
+        """Converts all texts into single array of indexes, and returns it
+        with offsets of each text in the array.
+
+        The tokens are looked up in chunks of `chunk_size` elements
+        independently of the texts boundaries.
+        """
+        offsets = np.cumsum([0] + [len(text) for text in texts], dtype=np.int64)
+        data = np.empty(offsets[-1], dtype=np.int32)
+        tokens = chain.from_iterable(texts)
+        for start in range(0, len(data), chunk_size):
+            chunk = list(islice(tokens, chunk_size))
+            data[start:start + len(chunk)] = self.lookup(chunk)
+        return data, offsets
+
+    def lookup(self, tokens):
+        """Converts a list of tokens into array of indexes using binary
+        search over the sorted vocabulary. The tokens that are not found in
+        the vocabulary are mapped to zero index.
+        """
+        arr = np.asarray(tokens, dtype=self._token_dtype)
+        pos = np.searchsorted(self._sorted, arr)
+        pos = pos.clip(0, len(self._sorted) - 1)
+        found = self._sorted[pos] == arr
+        return np.where(found, self._sorted_idx[pos], 0).astype(np.int32)
 
     def textify_all(self, samples):
         return [self.textify(sample) for sample in samples]
@@ -310,7 +465,7 @@ def compact_print(string):
 
 
 
-class SequenceIterator:
+class SequenceIterator(IterableDataset):
     """A wrapper on top of IMDB dataset that converts numericalized
     observations into format, suitable to train a language model.
 
@@ -318,13 +473,20 @@ class SequenceIterator:
     into two 2D arrays with tokens. The first array contains "previous" words,
     and the second one - "next" words. Each "previous" word is used to predict
     the "next" one. Therefore, we're getting a supervised training task.
+
+    When iterated by `DataLoader` with several workers, each worker yields
+    every n-th batch only. The workers sample the same sequence lengths, so
+    the loader returns batches in the original order.
     """
     def __init__(self, seq, bptt=10, split_size=64, random_length=True,
-                 flatten_target=True):
+                 flatten_target=True, seed=None):
 
         n_batches = seq.shape[0] // split_size
         truncated = seq[:n_batches * split_size]
         batches = truncated.view(split_size, -1).t().contiguous()
+        # the batches are views of this tensor, so it is moved into shared
+        # memory once instead of being copied there by each loader's worker
+        batches.share_memory_()
 
         self.bptt = bptt
         self.split_size = split_size
@@ -335,6 +497,11 @@ class SequenceIterator:
         self.curr_line = 0
         self.total_lines = batches.shape[0]
         self.total_iters = self.total_lines // self.bptt - 1
+        self.seed = np.random.randint(2**31) if seed is None else seed
+        self.epoch = 0
+        self.worker_id = 0
+        self.n_workers = 1
+        self.lengths = self.sample_lengths()
 
     @property
     def completed(self):
@@ -345,20 +512,28 @@ class SequenceIterator:
         return False
 
     def __iter__(self):
+        worker = get_worker_info()
+        if worker is not None:
+            self.worker_id, self.n_workers = worker.id, worker.num_workers
         self.curr_line = self.curr_iter = 0
+        self.epoch += 1
+        self.lengths = self.sample_lengths()
         return self
 
     def __next__(self):
         return self.next()
 
     def next(self):
-        if self.completed:
-            raise StopIteration()
-        seq_len = self.get_sequence_length()
-        batch = self.get_batch(seq_len)
-        self.curr_line += seq_len
-        self.curr_iter += 1
-        return batch
+        while True:
+            if self.completed:
+                raise StopIteration()
+            seq_len = self.get_sequence_length()
+            owned = self.curr_iter % self.n_workers == self.worker_id
+            batch = self.get_batch(seq_len) if owned else None
+            self.curr_line += seq_len
+            self.curr_iter += 1
+            if owned:
+                return batch
 
     def get_sequence_length(self):
         """
@@ -370,11 +545,19 @@ class SequenceIterator:
         """
         if self.random_length is None:
             return self.bptt
-        bptt = self.bptt
-        if np.random.random() >= 0.95:
-            bptt /= 2
-        seq_len = max(5, int(np.random.normal(bptt, 5)))
-        return seq_len
+        return int(self.lengths[self.curr_iter])
+
+    def sample_lengths(self):
+        """
+        Generates randomized sequence lengths for all iterations of the epoch
+        at once.
+        """
+        if self.random_length is None:
+            return None
+        n = max(0, self.total_iters)
+        rng = np.random.RandomState(self.seed + self.epoch)
+        bptt = np.where(rng.random_sample(n) >= 0.95, self.bptt/2, self.bptt)
+        return np.maximum(5, rng.normal(bptt, 5).astype(np.int64))
 
     def get_batch(self, seq_len):
         """
@@ -383,24 +566,18 @@ class SequenceIterator:
         """
         i, source = self.curr_line, self.batches
         seq_len = min(seq_len, self.total_lines - 1 - i)
-        X = source[i:i + seq_len].contiguous()
-        y = source[(i + 1):(i + 1) + seq_len].contiguous()
+        # slices along the first dimension of contiguous tensor are
+        # contiguous already, so no copy is required
+        X = source[i:i + seq_len]
+        y = source[(i + 1):(i + 1) + seq_len]
         if self.flatten_target:
             y = y.view(-1)
-        return X, y
+        # embeddings accept int32 indexes, but loss functions expect int64
+        return X, y.long()
 
 
 def to_sequence(dataset):
-    seq = concat(dataset.train_data if dataset.train else dataset.test_data)
-    return torch.LongTensor(seq)
-
-
-def concat(arrays):
-    seq = []
-    dtype = arrays[0].dtype
-    for arr in arrays:
-        seq.extend(arr.tolist())
-    return np.array(seq, dtype=dtype)
+    return torch.from_numpy(dataset.tokens)
 
 
 def to_np(tensor):
@@ -451,6 +628,8 @@ class RNNCore(nn.Module):
         if bs != self.bs:
             self.bs = bs
             self.create_hidden()
+        elif self.training:
+            self.hidden = clone_if_inference(self.hidden)
 
         raw_output = self.encoder(tensor)
         raw_outputs, new_hidden = [], []
@@ -549,6 +728,17 @@ def truncate_history(v):
         return tuple(truncate_history(x) for x in v)
 
 
+def clone_if_inference(v):
+    """
+    Converts tensors created in inference mode into normal tensors, so they
+    could be used in backward pass.
+    """
+    if type(v) == torch.Tensor:
+        return v.clone() if v.is_inference() else v
+    else:
+        return tuple(clone_if_inference(x) for x in v)
+
+
 def device(i=0, force_cpu=True):
     name = f'cuda:{i}' if torch.cuda.is_available() else 'cpu'
     if force_cpu:
@@ -51,6 +51,8 @@ class RNN(nn.Module):
         if bs != self.batch_size:
             self.hidden_state = self.init_hidden(bs)
             self.batch_size = bs
+        elif self.training:
+            self.hidden_state = clone_if_inference(self.hidden_state)
         embeddings = self.embed(batch)
         rnn_outputs, h = self.rnn(embeddings, self.hidden_state)
         self.hidden_state = truncate_history(h)
@@ -73,6 +75,17 @@ def truncate_history(v):
         return tuple(truncate_history(x) for x in v)
 
 
+def clone_if_inference(v):
+    """
+    Converts tensors created in inference mode into normal tensors, so they
+    could be used in backward pass.
+    """
+    if type(v) == torch.Tensor:
+        return v.clone() if v.is_inference() else v
+    else:
+        return tuple(clone_if_inference(x) for x in v)
+
+
 def generate_text(model, field, seed, n=500):
     string = seed
     for i in range(n):
@@ -70,7 +70,7 @@ class Vocab:
 
     def numericalize(self, texts):
         return [
-            np.array([self.stoi[token] for token in text], dtype=np.int)
+            np.array([self.stoi[token] for token in text], dtype=np.int32)
             for text in texts]
 
     def textify_all(self, samples):